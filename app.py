@@ -2,7 +2,9 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
+import io
 import os
 import uuid
 
@@ -16,209 +18,269 @@ except Exception:
 SUPABASE_URL = st.secrets.get("SUPABASE_URL", os.getenv("SUPABASE_URL"))
 SUPABASE_KEY = st.secrets.get("SUPABASE_KEY", os.getenv("SUPABASE_KEY"))
 
-supabase: Client | None = None
-if SUPABASE_URL and SUPABASE_KEY and create_client:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Streamlit re-executes this script on every rerun; cache_resource keeps one client (and its
+# HTTP connection pool) per process instead of building a new one each time
+@st.cache_resource(show_spinner=False)
+def get_client():
+    if SUPABASE_URL and SUPABASE_KEY and create_client:
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
+    return None
+
+
+supabase: Client | None = get_client()
+
+# --- Table loading ---
+PAGE_SIZE = 1000  # Supabase's default PostgREST max-rows; larger responses are silently truncated
+
+
+# Cached per (table, columns, order) so reruns and tab switches don't refetch; every write
+# path calls clear_cached_reads() so the next run sees its own changes.
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_table(name, columns="*", order="id"):
+    # Page through the result with range() so tables past max-rows are read in full.
+    # OFFSET paging needs a unique sort key, otherwise pages can repeat or skip rows.
+    data = []
+    while True:
+        query = supabase.table(name).select(columns).order(order)
+        res = query.range(len(data), len(data) + PAGE_SIZE - 1).execute()
+        page = res.data if hasattr(res, "data") and res.data else []
+        data.extend(page)
+        if len(page) < PAGE_SIZE:
+            break
+    # Keep the projected columns even when no rows come back
+    df = pd.DataFrame(data) if data or columns == "*" else pd.DataFrame(columns=columns.split(","))
+    # users.team_id repeats per member: as a category, the team-name map and groupby work on codes
+    if "team_id" in df.columns:
+        df["team_id"] = df["team_id"].astype("category")
+    return df
+
+
+def get_table(name, columns="*", order="id"):
+    try:
+        return fetch_table(name, columns, order)
+    except Exception as e:
+        st.warning(f"⚠️ Could not load {name}: {e}")
+        return pd.DataFrame()
+
+
+# Server-side aggregates (SQL functions in supabase/migrations) are cached the same way as table reads
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_rpc(fn, params=()):
+    res = supabase.rpc(fn, dict(params)).execute()
+    return pd.DataFrame(res.data if hasattr(res, "data") and res.data else [])
+
+
+def get_rpc(fn, params=()):
+    try:
+        return fetch_rpc(fn, params)
+    except Exception as e:
+        st.warning(f"⚠️ Could not load {fn}: {e}")
+        return pd.DataFrame()
+
+
+def clear_cached_reads():
+    # Writes invalidate every cached read: table pages and RPC aggregates alike
+    fetch_table.clear()
+    fetch_rpc.clear()
+
+
+def get_owner_totals(start, end, team_id=None):
+    # lead_owner_totals() filters and aggregates in Postgres: one row per (team, owner), not per lead
+    totals = get_rpc("lead_owner_totals", (("p_start", start), ("p_end", end), ("p_team", team_id)))
+    if totals.empty:
+        return totals
+    totals = totals.rename(columns={
+        "total_leads": "Total_Leads",
+        "converted": "Converted",
+        "total_sales": "Total_Sales",
+    })
+    totals["Total_Sales"] = pd.to_numeric(totals["Total_Sales"], errors="coerce").fillna(0)
+    return totals
+
+
+def get_today_totals(team_id, today):
+    return get_owner_totals(today.isoformat(), (today + timedelta(days=1)).isoformat(), team_id)
+
+
+def get_year_totals(year, team_id=None):
+    return get_owner_totals(f"{year}-01-01", f"{year + 1}-01-01", team_id)
+
+
+def conversion_pct(df):
+    # Plain array division; rows with no leads get 0 instead of inf/NaN
+    converted = df["Converted"].to_numpy(dtype="float64")
+    total = df["Total_Leads"].to_numpy(dtype="float64")
+    pct = np.divide(converted, total, out=np.zeros_like(converted), where=total > 0) * 100.0
+    return pct.round(2)
+
+
+# ✅ DB operations
+def insert_leads(team_id, owner_id, lead_count, date):
+    try:
+        # bulk_insert_leads() generates the identical rows in Postgres: one small request, and a
+        # single statement, so a failed batch leaves no partial set of leads behind
+        res = supabase.rpc("bulk_insert_leads", {
+            "p_team": team_id,
+            "p_owner": owner_id,
+            "p_n": int(lead_count),
+            "p_created": datetime.combine(date, datetime.min.time()).isoformat(),
+        }).execute()
+        clear_cached_reads()
+        st.success(f"✅ {int(res.data or 0)} leads added successfully for this member.")
+    except Exception as e:
+        st.error(f"Error inserting leads: {e}")
+
+
+def update_sales(team_id, owner_id, converted_count, sales_value, date):
+    try:
+        # claim_and_convert() picks the member's oldest unconverted leads, converts them and splits
+        # the sales value across the ones it actually claimed, all in one locked statement
+        res = supabase.rpc("claim_and_convert", {
+            "p_team": team_id,
+            "p_owner": owner_id,
+            "p_n": int(converted_count),
+            "p_total": float(sales_value),
+            "p_date": datetime.combine(date, datetime.min.time()).isoformat(),
+        }).execute()
+        claimed = int(res.data or 0)
+        if claimed:
+            clear_cached_reads()
+            if claimed < converted_count:
+                st.warning(
+                    f"⚠️ Only {claimed} unconverted lead(s) were available; "
+                    f"the sales value was split across those {claimed}."
+                )
+            else:
+                st.success(f"✅ {claimed} leads marked as converted.")
+        else:
+            st.warning("⚠️ No unconverted leads available for this member.")
+    except Exception as e:
+        st.error(f"Error updating sales: {e}")
 
 st.set_page_config(page_title="Lead Management App", layout="wide")
 st.title("📊 Lead Management System")
 
 tab = st.sidebar.radio("Go to", ["Dashboard", "Daily Upload", "Reporting", "Admin"])
 
+# Table reads are cached for a minute; this pulls in changes made from other sessions right away
+if st.sidebar.button("🔄 Refresh Data"):
+    clear_cached_reads()
+
 # ---------------------- Dashboard ----------------------
 # ---------------------- DASHBOARD ----------------------
 if tab == "Dashboard":
 
     st.header("📊 Dashboard Overview")
 
-    # ---------- Helper: Load Table ----------
-    def get_table(name):
-        try:
-            res = supabase.table(name).select("*").execute()
-            data = res.data if hasattr(res, "data") and res.data else []
-            df = pd.DataFrame(data)
-            # Ensure 'id' and 'team_id' columns exist even if table is empty
-            if "id" not in df.columns:
-                df["id"] = []
-            if "team_id" in df.columns:
-                df["team_id"] = df["team_id"].astype(str)
-            return df
-        except Exception as e:
-            st.warning(f"⚠️ Error loading {name}: {e}")
-            return pd.DataFrame(columns=["id"])
-
     # ---------- Load Data ----------
-    users_df = get_table("users")
-    teams_df = get_table("teams")
-    leads_df = get_table("leads")
-    targets_df = get_table("targets")
+    users_df = get_table("users", "id,name,team_id")
+    teams_df = get_table("teams", "id,name")
+    targets_df = get_table("targets", "user_id,weekly_target,monthly_target", order="user_id")
+    # Per-status counts come back pre-aggregated, so no lead rows are transferred
+    lead_counts = get_rpc("status_counts")
 
     # ---------- Safe Merge for Members ----------
     if not users_df.empty and "team_id" in users_df.columns and not teams_df.empty:
-        members = users_df.merge(
-            teams_df[["id", "name"]].rename(columns={"id": "team_id", "name": "team_name"}),
-            on="team_id", how="left"
-        )
+        # team_id is categorical, so map() resolves each distinct team once and reuses the codes
+        members = users_df.assign(team_name=users_df["team_id"].map(teams_df.set_index("id")["name"]))
     else:
         members = pd.DataFrame()
 
     # ---------- Summary Stats ----------
     total_teams = len(teams_df)
     total_members = len(users_df)
-    total_leads = len(leads_df)
-
-    st.markdown(
-        f"""
-        <div style='display:flex; justify-content:space-around; background:#f8f9fa;
-        border-radius:10px; padding:10px; margin-bottom:15px;'>
-            <div><b>🏢 Teams:</b> {total_teams}</div>
-            <div><b>👥 Members:</b> {total_members}</div>
-            <div><b>📋 Leads:</b> {total_leads}</div>
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
+    total_leads = int(lead_counts["count"].sum()) if not lead_counts.empty else 0
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("🏢 Teams", total_teams)
+    col2.metric("👥 Members", total_members)
+    col3.metric("📋 Leads", total_leads)
 
     # ---------- Leads Overview ----------
     st.subheader("📈 Leads Overview")
-    if leads_df.empty:
+    if lead_counts.empty:
         st.info("No leads data available yet.")
     else:
-        lead_counts = leads_df.groupby("status").size().reset_index(name="count")
-        st.dataframe(lead_counts, use_container_width=True)
+        st.dataframe(lead_counts, use_container_width=True, hide_index=True)
 
     # ---------- Members and Targets ----------
     st.subheader("🎯 Members & Targets")
+    # Nothing below has data to show without members; skip the merges and chart entirely
     if members.empty:
         st.info("No team or member data yet.")
-    else:
-        # Merge members with targets
-        if not targets_df.empty and "user_id" in targets_df.columns:
+        st.stop()
+
+    # Merge members with targets
+    if not targets_df.empty and "user_id" in targets_df.columns:
+        try:
             merged = members.merge(
                 targets_df.rename(columns={
                     "user_id": "id",
                     "weekly_target": "Weekly_Target",
                     "monthly_target": "Monthly_Target"
                 }),
-                on="id", how="left"
+                on="id", how="left", validate="one_to_one"
             )
-        else:
-            merged = members.copy()
-            merged["Weekly_Target"] = 0
-            merged["Monthly_Target"] = 0
-
-        # Display
-        st.dataframe(
-            merged[["name", "team_name", "Weekly_Target", "Monthly_Target"]],
-            use_container_width=True,
-            hide_index=True
-        )
+        except pd.errors.MergeError as e:
+            st.error(f"Duplicate rows in users or targets table: {e}")
+            st.stop()
+    else:
+        merged = members.assign(Weekly_Target=0, Monthly_Target=0)
 
-        # ---------- Summary by Team ----------
-        st.subheader("🏆 Team Target Summary")
-        team_summary = (
-            merged.groupby("team_name")[["Weekly_Target", "Monthly_Target"]]
-            .sum()
-            .reset_index()
-        )
-        st.dataframe(team_summary, use_container_width=True)
+    # Members without a targets row count as zero; fill and downcast only the numeric target columns
+    for col in ("Weekly_Target", "Monthly_Target"):
+        merged[col] = pd.to_numeric(merged[col].fillna(0), downcast="integer")
 
-        # ---------- Charts ----------
-        import matplotlib.pyplot as plt
+    # Display
+    st.dataframe(
+        merged[["name", "team_name", "Weekly_Target", "Monthly_Target"]],
+        use_container_width=True,
+        hide_index=True
+    )
 
-        if not team_summary.empty:
-            fig, ax = plt.subplots()
-            ax.bar(team_summary["team_name"], team_summary["Monthly_Target"])
-            ax.set_title("Monthly Targets by Team")
-            ax.set_xlabel("Team")
-            ax.set_ylabel("Monthly Target")
-            st.pyplot(fig)
+    # ---------- Summary by Team ----------
+    st.subheader("🏆 Team Target Summary")
+    team_summary = (
+        merged.groupby("team_name", observed=True)[["Weekly_Target", "Monthly_Target"]]
+        .sum()
+        .reset_index()
+    )
+    st.dataframe(team_summary, use_container_width=True, hide_index=True)
+
+    # ---------- Charts ----------
+    # Cached on the plotted values so reruns with unchanged targets reuse the figure
+    @st.cache_data(show_spinner=False)
+    def monthly_target_fig(bars):
+        from matplotlib.figure import Figure
+
+        fig = Figure()
+        ax = fig.subplots()
+        ax.bar([team for team, _ in bars], [target for _, target in bars])
+        ax.set_title("Monthly Targets by Team")
+        ax.set_xlabel("Team")
+        ax.set_ylabel("Monthly Target")
+        return fig
+
+    if not team_summary.empty:
+        st.pyplot(monthly_target_fig(tuple(zip(team_summary["team_name"], team_summary["Monthly_Target"]))))
 
 # ---------------------- Daily Upload ----------------------
 # ---------------------- Daily Upload ----------------------
 elif tab == "Daily Upload":
-    import pandas as pd
-    from datetime import datetime
-    import streamlit as st
-
     st.header("📤 Daily Lead Upload & Sales Update")
 
-    # ✅ Safe Supabase fetch helper
-    def get_table(name):
-        try:
-            res = supabase.table(name).select("*").execute()
-            df = pd.DataFrame(res.data if hasattr(res, "data") else res)
-            if not df.empty:
-                if "id" in df.columns:
-                    df["id"] = df["id"].astype(str)
-                if "team_id" in df.columns:
-                    df["team_id"] = df["team_id"].astype(str)
-            return df
-        except Exception as e:
-            st.warning(f"⚠️ Failed to fetch {name}: {e}")
-            return pd.DataFrame()
-
-    # ✅ DB operations
-    def insert_leads(team_id, owner_id, lead_count, date):
-        try:
-            rows = [{
-                "team_id": team_id,
-                "owner_id": owner_id,
-                "created_at": datetime.combine(date, datetime.min.time()).isoformat(),
-                "converted": False,
-                "sales_value": 0,
-            } for _ in range(int(lead_count))]
-            supabase.table("leads").insert(rows).execute()
-            st.success(f"✅ {lead_count} leads added successfully for this member.")
-        except Exception as e:
-            st.error(f"Error inserting leads: {e}")
-
-    def update_sales(team_id, owner_id, converted_count, sales_value, date):
-        try:
-            leads_to_update = (
-                supabase.table("leads")
-                .select("id")
-                .eq("team_id", team_id)
-                .eq("owner_id", owner_id)
-                .eq("converted", False)
-                .limit(converted_count)
-                .execute()
-            )
-            if hasattr(leads_to_update, "data") and leads_to_update.data:
-                ids = [r["id"] for r in leads_to_update.data]
-                per_lead_value = float(sales_value) / len(ids) if ids else 0
-                for lid in ids:
-                    supabase.table("leads").update({
-                        "converted": True,
-                        "sales_value": per_lead_value,
-                        "updated_at": datetime.combine(date, datetime.min.time()).isoformat()
-                    }).eq("id", lid).execute()
-                st.success(f"✅ {len(ids)} leads marked as converted.")
-            else:
-                st.warning("⚠️ No unconverted leads available for this member.")
-        except Exception as e:
-            st.error(f"Error updating sales: {e}")
-
-    def get_leads():
-        try:
-            res = supabase.table("leads").select("*").execute()
-            df = pd.DataFrame(res.data if hasattr(res, "data") else res)
-            if not df.empty and "created_at" in df.columns:
-                df["created_at"] = pd.to_datetime(df["created_at"], errors="coerce")
-            return df
-        except Exception:
-            return pd.DataFrame()
-
     # ✅ Load base data
-    teams_df = get_table("teams")
-    users_df = get_table("users")
-    leads_df = get_leads()
+    teams_df = get_table("teams", "id,name")
+    users_df = get_table("users", "id,name,team_id")
+
+    team_dict = dict(zip(teams_df["name"], teams_df["id"])) if not teams_df.empty else {}
 
-    team_dict = {r["name"]: r["id"] for _, r in teams_df.iterrows()} if not teams_df.empty else {}
+    # Resolve "today" once so both form defaults and the summary agree across a UTC midnight
+    today = datetime.utcnow().date()
 
     # --- Step 1: Select Team ---
     st.subheader("🏢 Select Team")
-    selected_team_name = st.selectbox("Team", list(team_dict.keys()) if team_dict else ["No Teams Found"])
+    selected_team_name = st.selectbox("Team", list(team_dict) if team_dict else ["No Teams Found"])
     selected_team_id = team_dict.get(selected_team_name)
 
     # --- Step 2: Filter Members by Team ---
@@ -227,21 +289,25 @@ elif tab == "Daily Upload":
     else:
         filtered_members = pd.DataFrame()
 
-    member_dict = {m["name"]: m["id"] for _, m in filtered_members.iterrows()} if not filtered_members.empty else {}
+    member_dict = (
+        dict(zip(filtered_members["name"], filtered_members["id"]))
+        if not filtered_members.empty else {}
+    )
 
     st.markdown("---")
 
     # --- Form 1: Add Daily Leads ---
     st.subheader("📋 Add Daily Leads")
     with st.form("daily_leads_form"):
-        member_name = st.selectbox("Select Team Member", list(member_dict.keys()) if member_dict else ["No Members"])
+        member_name = st.selectbox("Select Team Member", list(member_dict) if member_dict else ["No Members"])
         lead_count = st.number_input("Lead Count", min_value=1, value=1)
-        date = st.date_input("Select Date", datetime.utcnow().date())
+        date = st.date_input("Select Date", today)
         submitted = st.form_submit_button("Submit Leads")
 
         if submitted:
-            if selected_team_id and member_dict.get(member_name):
-                insert_leads(selected_team_id, member_dict.get(member_name), lead_count, date)
+            member_id = member_dict.get(member_name)
+            if selected_team_id and member_id:
+                insert_leads(selected_team_id, member_id, lead_count, date)
             else:
                 st.warning("⚠️ Please select a valid team and member.")
 
@@ -250,15 +316,16 @@ elif tab == "Daily Upload":
     # --- Form 2: Update Sales Conversion ---
     st.subheader("💰 Update Converted Leads & Sales Value")
     with st.form("update_sales_form"):
-        member_name2 = st.selectbox("Select Team Member", list(member_dict.keys()) if member_dict else ["No Members"], key="sales_member")
+        member_name2 = st.selectbox("Select Team Member", list(member_dict) if member_dict else ["No Members"], key="sales_member")
         converted = st.number_input("Converted Leads", min_value=0, value=0)
         sales_value = st.number_input("Total Sales Value", min_value=0.0, value=0.0)
-        date2 = st.date_input("Conversion Date", datetime.utcnow().date())
+        date2 = st.date_input("Conversion Date", today)
         submitted2 = st.form_submit_button("Update Sales")
 
         if submitted2:
-            if selected_team_id and member_dict.get(member_name2):
-                update_sales(selected_team_id, member_dict.get(member_name2), converted, sales_value, date2)
+            member_id = member_dict.get(member_name2)
+            if selected_team_id and member_id:
+                update_sales(selected_team_id, member_id, converted, sales_value, date2)
             else:
                 st.warning("⚠️ Please select a valid team and member.")
 
@@ -267,89 +334,55 @@ elif tab == "Daily Upload":
     # ✅ Today’s Summary Table
     st.subheader("📊 Today's Summary")
 
-    if leads_df.empty or selected_team_id is None:
+    if selected_team_id is None:
         st.info("No leads found.")
     else:
-        today = datetime.utcnow().date()
-        team_leads = leads_df[
-            (leads_df["team_id"] == selected_team_id)
-            & (leads_df["created_at"].dt.date == today)
-        ].copy()
+        # Already one row per member, aggregated in Postgres
+        summary = get_today_totals(selected_team_id, today)
 
-        if team_leads.empty:
+        if summary.empty:
             st.info(f"No leads submitted today for team: {selected_team_name}")
         else:
-            # Aggregate summary by member
-            summary = (
-                team_leads.groupby("owner_id")
-                .agg(
-                    Total_Leads=("id", "count"),
-                    Converted=("converted", "sum"),
-                    Total_Sales=("sales_value", "sum")
-                )
-                .reset_index()
-            )
+            summary["Conversion_%"] = conversion_pct(summary)
 
-            summary["Conversion_%"] = (summary["Converted"] / summary["Total_Leads"] * 100).round(2)
+            # Attach member names by mapping owner_id against the id-indexed users
+            summary["Member"] = summary["owner_id"].map(users_df.set_index("id")["name"])
+            summary = summary[["Member", "Total_Leads", "Converted", "Total_Sales", "Conversion_%"]]
 
-            # Merge with member names
-            summary = summary.merge(
-                users_df[["id", "name"]].rename(columns={"id": "owner_id", "name": "Member"}),
-                on="owner_id", how="left"
-            )[["Member", "Total_Leads", "Converted", "Total_Sales", "Conversion_%"]]
-
-            st.dataframe(summary, use_container_width=True)
+            st.dataframe(summary, use_container_width=True, hide_index=True)
 # ---------------------- Reporting ----------------------
 # ---------------------- Reporting ----------------------
 elif tab == "Reporting":
     st.header("📊 Reporting & Insights")
     st.caption("View weekly or monthly summaries of team and member performance")
 
-    # --- Load Data Helper ---
-    def get_table(name):
-        try:
-            res = supabase.table(name).select("*").execute()
-            df = pd.DataFrame(res.data if hasattr(res, "data") else res)
-            if not df.empty and "id" in df.columns:
-                df["id"] = df["id"].astype(str)
-            if "team_id" in df.columns:
-                df["team_id"] = df["team_id"].astype(str)
-            return df
-        except Exception as e:
-            st.warning(f"⚠️ Could not load {name}: {e}")
-            return pd.DataFrame()
-
     # --- Fetch Data ---
-    teams_df = get_table("teams")
-    users_df = get_table("users")
-    leads_df = get_table("leads")
-
-    if leads_df.empty:
-        st.info("No lead data available yet.")
-        st.stop()
-
-    # --- Clean up date fields ---
-    leads_df["created_at"] = pd.to_datetime(leads_df["created_at"], errors="coerce")
-    leads_df["week"] = leads_df["created_at"].dt.isocalendar().week
-    leads_df["month"] = leads_df["created_at"].dt.month
-    leads_df["year"] = leads_df["created_at"].dt.year
+    teams_df = get_table("teams", "id,name")
+    users_df = get_table("users", "id,name,team_id")
+    name_to_team_id = dict(zip(teams_df["name"], teams_df["id"])) if not teams_df.empty else {}
 
     # --- Filters ---
     st.sidebar.header("📅 Filters")
     report_type = st.sidebar.selectbox("Report Type", ["Weekly", "Monthly"])
-    selected_team = st.sidebar.selectbox("Team", ["All"] + list(teams_df["name"]))
-    selected_year = st.sidebar.number_input("Year", min_value=2020, max_value=datetime.now().year, value=datetime.now().year)
+    selected_team = st.sidebar.selectbox("Team", ["All", *name_to_team_id])
+    current_year = datetime.now().year
+    selected_year = st.sidebar.number_input("Year", min_value=2020, max_value=current_year, value=current_year)
 
-    # --- Apply Filters ---
-    df_filtered = leads_df[leads_df["year"] == selected_year]
+    team_id = None
     if selected_team != "All":
-        team_id = teams_df.loc[teams_df["name"] == selected_team, "id"].values[0]
-        df_filtered = df_filtered[df_filtered["team_id"] == team_id]
+        team_id = name_to_team_id[selected_team]
+    # One row per (team, owner), aggregated in Postgres; team and member summaries roll up from it
+    owner_totals = get_year_totals(int(selected_year), team_id)
+
+    if owner_totals.empty:
+        st.info("No lead data available for the selected filters.")
+        st.stop()
+    total_cols = ["Total_Leads", "Converted", "Total_Sales"]
 
     # --- Summary Metrics ---
-    total_leads = len(df_filtered)
-    converted = df_filtered["converted"].sum()
-    total_sales = df_filtered["sales_value"].sum()
+    total_leads = int(owner_totals["Total_Leads"].sum())
+    converted = owner_totals["Converted"].sum()
+    total_sales = owner_totals["Total_Sales"].sum()
     conversion_rate = (converted / total_leads * 100) if total_leads > 0 else 0
 
     col1, col2, col3, col4 = st.columns(4)
@@ -360,69 +393,66 @@ elif tab == "Reporting":
 
     st.markdown("---")
 
+    # id -> name lookups used to label both summaries without merging
+    team_names = teams_df.set_index("id")["name"]
+    users_by_id = users_df.set_index("id")
+
     # --- Team Performance Summary ---
     st.subheader("🏢 Team Performance Summary")
-    team_summary = (
-        df_filtered.groupby("team_id")
-        .agg(
-            Total_Leads=("id", "count"),
-            Converted=("converted", "sum"),
-            Total_Sales=("sales_value", "sum"),
-        )
-        .reset_index()
-    )
+    team_summary = owner_totals.groupby("team_id")[total_cols].sum().reset_index()
+    team_summary["Team"] = team_summary["team_id"].map(team_names)
+    team_summary = team_summary[["Team"] + total_cols]
 
-    team_summary = team_summary.merge(
-        teams_df[["id", "name"]], left_on="team_id", right_on="id", how="left"
-    ).rename(columns={"name": "Team"})[["Team", "Total_Leads", "Converted", "Total_Sales"]]
+    team_summary["Conversion_%"] = conversion_pct(team_summary)
 
-    team_summary["Conversion_%"] = (team_summary["Converted"] / team_summary["Total_Leads"] * 100).round(2)
-
-    st.dataframe(team_summary, use_container_width=True)
+    st.dataframe(team_summary, use_container_width=True, hide_index=True)
 
     # --- Member Leaderboard ---
     st.subheader("🏆 Member Leaderboard")
-    member_summary = (
-        df_filtered.groupby("owner_id")
-        .agg(
-            Total_Leads=("id", "count"),
-            Converted=("converted", "sum"),
-            Total_Sales=("sales_value", "sum"),
-        )
-        .reset_index()
-    )
-
-    member_summary = (
-        member_summary.merge(users_df[["id", "name", "team_id"]], left_on="owner_id", right_on="id", how="left")
-        .merge(teams_df[["id", "name"]].rename(columns={"id": "team_id", "name": "Team"}), on="team_id", how="left")
-        .rename(columns={"name": "Member"})
-    )[["Member", "Team", "Total_Leads", "Converted", "Total_Sales"]]
+    member_summary = owner_totals.groupby("owner_id")[total_cols].sum().reset_index()
+    member_summary["Member"] = member_summary["owner_id"].map(users_by_id["name"])
+    member_summary["Team"] = member_summary["owner_id"].map(users_by_id["team_id"]).map(team_names)
+    member_summary = member_summary[["Member", "Team"] + total_cols]
 
-    member_summary["Conversion_%"] = (member_summary["Converted"] / member_summary["Total_Leads"] * 100).round(2)
+    member_summary["Conversion_%"] = conversion_pct(member_summary)
     member_summary = member_summary.sort_values("Total_Sales", ascending=False)
 
-    st.dataframe(member_summary, use_container_width=True)
+    st.dataframe(member_summary, use_container_width=True, hide_index=True)
 
     # --- Export Reports ---
     st.markdown("### 📁 Export Reports")
-    csv_data = member_summary.to_csv(index=False).encode("utf-8")
+
+    # Write the CSV straight into a bytes buffer instead of building a str and re-encoding it
+    csv_buffer = io.BytesIO()
+    member_summary.to_csv(csv_buffer, index=False, encoding="utf-8")
 
     st.download_button(
         label="📥 Download Member Report (CSV)",
-        data=csv_data,
+        data=csv_buffer.getvalue(),
         file_name=f"member_report_{report_type.lower()}_{selected_year}.csv",
         mime="text/csv",
     )
 
     # Excel export
-    import io
-    excel_buffer = io.BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine="xlsxwriter") as writer:
-        team_summary.to_excel(writer, sheet_name="Team Summary", index=False)
-        member_summary.to_excel(writer, sheet_name="Member Leaderboard", index=False)
+    @st.cache_data(show_spinner=False)
+    def build_excel_report(sheets):
+        # constant_memory flushes each row as soon as the next one starts, so rows are written
+        # in order with xlsxwriter directly (DataFrame.to_excel writes column by column)
+        import xlsxwriter
+
+        excel_buffer = io.BytesIO()
+        workbook = xlsxwriter.Workbook(excel_buffer, {"constant_memory": True, "strings_to_urls": False})
+        for sheet_name, df in sheets:
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, list(df.columns))
+            for row_num, row in enumerate(df.itertuples(index=False), start=1):
+                worksheet.write_row(row_num, 0, [None if pd.isna(v) else v for v in row])
+        workbook.close()
+        return excel_buffer.getvalue()
+
     st.download_button(
         label="📘 Download Full Report (Excel)",
-        data=excel_buffer.getvalue(),
+        data=build_excel_report((("Team Summary", team_summary), ("Member Leaderboard", member_summary))),
         file_name=f"lead_report_{report_type.lower()}_{selected_year}.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
@@ -450,13 +480,9 @@ elif tab == "Admin":
     st.write("Manage users, teams, and targets here.")
 
     # --- Load data safely ---
-    try:
-        users_df = pd.DataFrame(supabase.table("users").select("*").execute().data)
-        teams_df = pd.DataFrame(supabase.table("teams").select("*").execute().data)
-        targets_df = pd.DataFrame(supabase.table("targets").select("*").execute().data)
-    except Exception as e:
-        st.error(f"Error loading data: {e}")
-        st.stop()
+    users_df = get_table("users", "id,name,team_id")
+    teams_df = get_table("teams", "id,name")
+    targets_df = get_table("targets", "user_id,weekly_target,monthly_target", order="user_id")
 
     # --- Handle empty tables gracefully ---
     if users_df.empty:
@@ -468,12 +494,19 @@ elif tab == "Admin":
     if targets_df.empty:
         targets_df = pd.DataFrame(columns=["user_id", "weekly_target", "monthly_target"])
 
+    name_to_team_id = dict(zip(teams_df["name"], teams_df["id"]))
+    team_names = list(name_to_team_id)
+
     # --- Merge users with teams ---
     if "team_id" in users_df.columns and "id" in teams_df.columns:
-        members = users_df.merge(
-            teams_df[["id", "name"]].rename(columns={"id": "team_id", "name": "team_name"}),
-            on="team_id", how="left"
-        )
+        try:
+            members = users_df.merge(
+                teams_df[["id", "name"]].rename(columns={"id": "team_id", "name": "team_name"}),
+                on="team_id", how="left", validate="many_to_one"
+            )
+        except pd.errors.MergeError as e:
+            st.error(f"Duplicate team ids in teams table: {e}")
+            st.stop()
     else:
         st.error("Missing columns in users or teams table.")
         st.stop()
@@ -484,66 +517,84 @@ elif tab == "Admin":
         "monthly_target": "Monthly_Target",
         "user_id": "id"
     })
-    users_targets = users_df.merge(merged_targets, on="id", how="left")
+    try:
+        members_view = members.merge(merged_targets, on="id", how="left", validate="one_to_one")
+    except pd.errors.MergeError as e:
+        st.error(f"Duplicate rows in users or targets table: {e}")
+        st.stop()
+    members_view["Weekly_Target"] = members_view["Weekly_Target"].fillna(0).astype(int)
+    members_view["Monthly_Target"] = members_view["Monthly_Target"].fillna(0).astype(int)
+    members_view = members_view[["id", "name", "team_name", "Weekly_Target", "Monthly_Target"]]
 
     # --- Display user management table ---
+    # One data_editor for all members instead of a row of widgets + form per member
     st.subheader("👥 Manage Team Members")
-    for _, member in members.iterrows():
-        col1, col2, col3, col4 = st.columns([3, 3, 2, 2])
-        col1.write(f"**{member['name']}**")
-        col2.write(f"Team: {member.get('team_name', 'N/A')}")
-        col3.write(f"Weekly: {member.get('Weekly_Target', 0)} | Monthly: {member.get('Monthly_Target', 0)}")
-
-        if col4.button("✏️ Edit", key=f"edit_{member['id']}"):
-            with st.form(f"edit_member_{member['id']}", clear_on_submit=True):
-                st.write(f"### Edit {member['name']}")
-
-                # --- Fix: Safe index lookup for team selection ---
-                existing_team_ids = list(teams_df["id"])
-                default_index = (
-                    existing_team_ids.index(member["team_id"])
-                    if member.get("team_id") in existing_team_ids
-                    else 0
-                )
-
-                new_team = st.selectbox(
-                    "Switch Team",
-                    options=list(teams_df["name"]),
-                    index=default_index
-                )
-
-                new_weekly = st.number_input(
-                    "Weekly Target",
-                    value=int(member.get("Weekly_Target", 0))
-                )
-                new_monthly = st.number_input(
-                    "Monthly Target",
-                    value=int(member.get("Monthly_Target", 0))
-                )
-
-                save = st.form_submit_button("💾 Save Changes")
 
-                if save:
-                    try:
-                        new_team_id = teams_df.loc[
-                            teams_df["name"] == new_team, "id"
-                        ].values[0]
-
-                        # Update team
-                        supabase.table("users").update(
-                            {"team_id": new_team_id}
-                        ).eq("id", member["id"]).execute()
+    # Fragment: paging and cell edits rerun only the editor, not the Supabase loads above
+    @st.fragment
+    def members_editor(members_view):
+        # Page the editor so each rerun only serializes and diffs one page of members
+        members_per_page = 50
+        n_pages = max(1, -(-len(members_view) // members_per_page))
+        if n_pages > 1:
+            page = st.number_input("Page", min_value=1, max_value=n_pages, value=1, help="Save changes before switching pages.")
+            members_view = members_view.iloc[(page - 1) * members_per_page:page * members_per_page]
+        else:
+            page = 1
+
+        edited = st.data_editor(
+            members_view,
+            key=f"members_editor_{page}",
+            num_rows="fixed",
+            hide_index=True,
+            disabled=["id", "name"],
+            column_config={
+                "id": None,
+                "name": "Member",
+                "team_name": st.column_config.SelectboxColumn("Team", options=team_names, required=True),
+                "Weekly_Target": st.column_config.NumberColumn("Weekly Target", min_value=0, step=1),
+                "Monthly_Target": st.column_config.NumberColumn("Monthly Target", min_value=0, step=1),
+            },
+        )
 
-                        # Update targets
-                        supabase.table("targets").update({
-                            "weekly_target": new_weekly,
-                            "monthly_target": new_monthly
-                        }).eq("user_id", member["id"]).execute()
+        if st.button("💾 Save Changes"):
+            # Diff against what was loaded so only edited rows are written
+            diff = edited.ne(members_view) & ~(edited.isna() & members_view.isna())
+            team_changed = diff["team_name"]
+            targets_changed = diff[["Weekly_Target", "Monthly_Target"]].any(axis=1)
 
-                        st.success(f"✅ Updated {member['name']}'s details.")
-                        st.experimental_rerun()
-                    except Exception as e:
-                        st.error(f"Error updating member: {e}")
+            if not (team_changed | targets_changed).any():
+                st.info("No changes to save.")
+            else:
+                try:
+                    changed_users = [
+                        {"id": r["id"], "name": r["name"], "team_id": name_to_team_id[r["team_name"]]}
+                        for r in edited[team_changed].to_dict("records")
+                    ]
+                    changed_targets = [
+                        {
+                            "user_id": r["id"],
+                            "weekly_target": int(r["Weekly_Target"]),
+                            "monthly_target": int(r["Monthly_Target"]),
+                        }
+                        for r in edited[targets_changed].to_dict("records")
+                    ]
+
+                    if changed_users:
+                        supabase.table("users").upsert(changed_users).execute()
+                    if changed_targets:
+                        supabase.table("targets").upsert(changed_targets, on_conflict="user_id").execute()
+
+                    clear_cached_reads()
+                    # Drop the editor's pending edits; they are stored by row position and would
+                    # otherwise be replayed over fresh data on a later Save
+                    st.session_state.pop(f"members_editor_{page}", None)
+                    st.success(f"✅ Updated {int((team_changed | targets_changed).sum())} member(s).")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error updating members: {e}")
+
+    members_editor(members_view)
 
     st.markdown("---")
 
@@ -551,7 +602,7 @@ elif tab == "Admin":
     st.subheader("➕ Add New Member")
     with st.form("add_member_form"):
         new_name = st.text_input("Full Name")
-        new_team = st.selectbox("Assign to Team", options=list(teams_df["name"]))
+        new_team = st.selectbox("Assign to Team", options=team_names)
         new_weekly = st.number_input("Weekly Target", min_value=0)
         new_monthly = st.number_input("Monthly Target", min_value=0)
 
@@ -559,28 +610,23 @@ elif tab == "Admin":
 
         if submitted:
             try:
-                new_team_id = teams_df.loc[teams_df["name"] == new_team, "id"].values[0]
+                new_team_id = name_to_team_id[new_team]
 
                 # Manually assign a unique user ID (important!)
-                import uuid
                 new_user_id = str(uuid.uuid4())
 
-                # Insert into users table
-                supabase.table("users").insert({
-                    "id": new_user_id,
-                    "name": new_name,
-                    "team_id": new_team_id
-                }).execute()
-
-                # Insert targets
-                supabase.table("targets").insert({
-                    "user_id": new_user_id,
-                    "weekly_target": new_weekly,
-                    "monthly_target": new_monthly
+                # Insert the user and its targets together: one request, one transaction
+                supabase.rpc("create_member_with_targets", {
+                    "p_id": new_user_id,
+                    "p_name": new_name,
+                    "p_team": new_team_id,
+                    "p_weekly": int(new_weekly),
+                    "p_monthly": int(new_monthly),
                 }).execute()
 
+                clear_cached_reads()
                 st.success(f"✅ Added {new_name} successfully!")
-                st.experimental_rerun()
+                st.rerun()
 
             except Exception as e:
                 st.error(f"Error adding member: {e}")
@@ -595,13 +641,13 @@ elif tab == "Admin":
 
         if add_team:
             try:
-                import uuid
                 new_team_id = str(uuid.uuid4())
                 supabase.table("teams").insert({
                     "id": new_team_id,
                     "name": new_team_name
                 }).execute()
+                clear_cached_reads()
                 st.success(f"✅ Added new team: {new_team_name}")
-                st.experimental_rerun()
+                st.rerun()
             except Exception as e:
                 st.error(f"Error adding team: {e}")
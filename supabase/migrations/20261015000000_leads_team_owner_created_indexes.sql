@@ -0,0 +1,15 @@
+-- Indexes backing the lead queries issued by app.py
+
+-- Daily Upload "Today's Summary" and Reporting with a team selected:
+--   eq(team_id) + gte/lt(created_at)
+create index if not exists idx_leads_team_created
+    on public.leads (team_id, created_at desc);
+
+-- update_sales picks a member's unconverted leads:
+--   eq(team_id) + eq(owner_id) + eq(converted, false)
+create index if not exists idx_leads_owner_created
+    on public.leads (owner_id, created_at desc);
+
+-- Reporting with "All" teams: gte/lt(created_at) only
+create index if not exists idx_leads_created
+    on public.leads (created_at desc);
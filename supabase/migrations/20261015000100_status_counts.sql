@@ -0,0 +1,12 @@
+-- Dashboard "Leads Overview": one row per status instead of one row per lead.
+-- The counts also sum to the Dashboard's total lead count.
+create or replace function public.status_counts()
+returns table (status text, count bigint)
+language sql
+stable
+as $$
+    select status::text, count(*)
+    from public.leads
+    group by status
+    order by status;
+$$;
@@ -0,0 +1,39 @@
+-- update_sales: claim up to p_n of a member's oldest unconverted leads and mark them converted
+-- in one statement. FOR UPDATE SKIP LOCKED keeps concurrent sessions from claiming the same
+-- leads. p_total is split over the leads actually claimed, so the recorded sales always add up
+-- to the amount entered. Returns the number of leads converted.
+create or replace function public.claim_and_convert(
+    p_team uuid,
+    p_owner uuid,
+    p_n integer,
+    p_total numeric,
+    p_date timestamptz
+)
+returns integer
+language sql
+volatile
+as $$
+    with claimed as (
+        select id
+        from public.leads
+        where team_id = p_team
+          and owner_id = p_owner
+          and not converted
+        order by created_at
+        limit p_n
+        for update skip locked
+    ),
+    claimed_count as (
+        select count(*) as n from claimed
+    ),
+    converted_rows as (
+        update public.leads l
+        set converted = true,
+            sales_value = p_total / claimed_count.n,
+            updated_at = p_date
+        from claimed, claimed_count
+        where l.id = claimed.id
+        returning 1
+    )
+    select count(*)::integer from converted_rows;
+$$;
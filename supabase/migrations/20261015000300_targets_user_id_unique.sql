@@ -0,0 +1,6 @@
+-- Admin "Save Changes" upserts targets with on_conflict=user_id, which PostgREST can only
+-- resolve against a unique index or constraint on that column. It also makes user_id a
+-- stable key for paging the targets table. Existing duplicate user_id rows must be merged
+-- before this index can be created.
+create unique index if not exists targets_user_id_key
+    on public.targets (user_id);
@@ -0,0 +1,30 @@
+-- Per (team, owner) lead totals for a created_at window, optionally limited to one team.
+-- Daily Upload "Today's Summary" and Reporting receive one row per member instead of one
+-- row per lead. Served by the team/created_at and created_at indexes.
+create or replace function public.lead_owner_totals(
+    p_start timestamptz,
+    p_end timestamptz,
+    p_team uuid default null
+)
+returns table (
+    team_id uuid,
+    owner_id uuid,
+    total_leads bigint,
+    converted bigint,
+    total_sales numeric
+)
+language sql
+stable
+as $$
+    select l.team_id,
+           l.owner_id,
+           count(*),
+           count(*) filter (where l.converted),
+           coalesce(sum(l.sales_value), 0)
+    from public.leads l
+    where l.created_at >= p_start
+      and l.created_at < p_end
+      and (p_team is null or l.team_id = p_team)
+    group by l.team_id, l.owner_id
+    order by l.team_id, l.owner_id;
+$$;
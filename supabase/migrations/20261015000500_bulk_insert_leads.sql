@@ -0,0 +1,21 @@
+-- insert_leads: create p_n identical leads with generate_series in one statement, so the
+-- request carries four parameters instead of p_n rows and a batch lands entirely or not at all.
+-- Returns the number of leads inserted.
+create or replace function public.bulk_insert_leads(
+    p_team uuid,
+    p_owner uuid,
+    p_n integer,
+    p_created timestamptz
+)
+returns integer
+language sql
+volatile
+as $$
+    with inserted as (
+        insert into public.leads (team_id, owner_id, created_at, converted, sales_value)
+        select p_team, p_owner, p_created, false, 0
+        from generate_series(1, p_n)
+        returning 1
+    )
+    select count(*)::integer from inserted;
+$$;
@@ -0,0 +1,23 @@
+-- Admin "Add Member": insert the user and its targets row in one transaction, so a failed
+-- targets insert can't leave an orphan user behind, and the form needs one request, not two.
+create or replace function public.create_member_with_targets(
+    p_id uuid,
+    p_name text,
+    p_team uuid,
+    p_weekly integer,
+    p_monthly integer
+)
+returns uuid
+language plpgsql
+volatile
+as $$
+begin
+    insert into public.users (id, name, team_id)
+    values (p_id, p_name, p_team);
+
+    insert into public.targets (user_id, weekly_target, monthly_target)
+    values (p_id, p_weekly, p_monthly);
+
+    return p_id;
+end;
+$$;